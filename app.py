@@ -1,12 +1,25 @@
 import streamlit as st
+from streamlit import runtime
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import orjson
+import logging
 import uuid
 from datetime import datetime, timedelta
-import pytz
+from zoneinfo import ZoneInfo
+import os
 import re
-import random
+import base64
+import socket
+import time
+import secrets
 import hashlib
+import hmac
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from pathlib import Path
 
 # Page configuration - optimized for mobile
 st.set_page_config(
@@ -16,317 +29,413 @@ st.set_page_config(
     initial_sidebar_state="collapsed"  # Collapsed by default for mobile
 )
 
-# Mobile-friendly CSS
-st.markdown("""
-<style>
-    /* Mobile-first responsive design */
-    @media (max-width: 768px) {
-        /* Reduce padding on mobile */
-        .main .block-container {
-            padding-top: 1rem;
-            padding-left: 1rem;
-            padding-right: 1rem;
-            padding-bottom: 1rem;
-            max-width: 100%;
-        }
-        
-        /* Make sidebar collapsible and overlay on mobile */
-        section[data-testid="stSidebar"] {
-            width: 80% !important;
-            max-width: 300px;
-        }
-        
-        /* Adjust text sizes for mobile */
-        h1 {
-            font-size: 1.75rem !important;
-        }
-        
-        h2 {
-            font-size: 1.5rem !important;
-        }
-        
-        h3 {
-            font-size: 1.25rem !important;
-        }
-        
-        /* Make buttons larger and easier to tap */
-        .stButton > button {
-            width: 100%;
-            padding: 0.75rem 1rem !important;
-            font-size: 1rem !important;
-            margin-bottom: 0.5rem;
-        }
-        
-        /* Improve text input on mobile */
-        .stTextInput > div > div > input,
-        .stTextArea > div > div > textarea {
-            font-size: 16px !important; /* Prevents zoom on iOS */
-            padding: 0.75rem !important;
-        }
-        
-        /* Adjust chat messages */
-        .stChatMessage {
-            padding: 0.75rem !important;
-            margin-bottom: 0.5rem !important;
-        }
-        
-        /* Make expanders more touch-friendly */
-        .streamlit-expanderHeader {
-            padding: 0.75rem !important;
-            font-size: 1rem !important;
-        }
-        
-        /* Adjust columns to stack on mobile */
-        .row-widget.stHorizontal {
-            flex-direction: column !important;
-        }
-        
-        /* Better spacing for mobile */
-        .element-container {
-            margin-bottom: 0.5rem;
-        }
-        
-        /* Stack columns vertically on mobile */
-        [data-testid="column"] {
-            width: 100% !important;
-            flex: 1 1 100% !important;
-        }
-    }
-    
-    /* General improvements for all screen sizes */
-    .stChatMessage {
-        border-radius: 10px;
-    }
-    
-    /* Improve conversation list appearance */
-    .conversation-item {
-        padding: 0.75rem;
-        margin-bottom: 0.5rem;
-        border-radius: 8px;
-        cursor: pointer;
-        transition: background-color 0.2s;
-    }
-    
-    /* Better touch targets for mobile */
-    @media (max-width: 768px) {
-        .stSelectbox, .stNumberInput, .stSlider {
-            margin-bottom: 1rem;
-        }
-        
-        /* Larger radio buttons */
-        .stRadio > div {
-            padding: 0.5rem 0;
-        }
-    }
-    
-    /* Improve assessment state display */
-    .assessment-section {
-        background-color: #f8f9fa;
-        padding: 1rem;
-        border-radius: 8px;
-        margin-bottom: 0.75rem;
-    }
-    
-    @media (max-width: 768px) {
-        .assessment-section {
-            padding: 0.75rem;
-        }
-    }
-</style>
-""", unsafe_allow_html=True)
+# Mobile-friendly and chat CSS, kept in static/ (static serving would send .css as text/plain)
+STATIC_DIR = Path(__file__).parent / "static"
+
+@st.cache_resource(show_spinner=False)
+def load_app_css() -> str:
+    """Mobile and chat CSS as one minified <style> block, read once per process"""
+    css = "".join((STATIC_DIR / name).read_text() for name in ("mobile.css", "chat.css"))
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};])\s*', r'\1', css)
+    return f"<style>{css.strip()}</style>"
+
+# Streamlit removes any element a run doesn't re-emit, so the styles have to be sent
+# on every rerun; they are kept small instead (one minified, style-only st.html element)
+st.html(load_app_css())
+
+logger = logging.getLogger(__name__)
 
 # Timezone configuration (UTC+8)
-LOCAL_TZ = pytz.timezone('Asia/Singapore')  # UTC+8
+LOCAL_TZ = ZoneInfo('Asia/Singapore')  # UTC+8
+
+# Query param writes are queued in session state and applied once per run
+def set_query_param(key: str, value):
+    """Queue a query param write (None removes the param)"""
+    st.session_state.setdefault('_pending_query_params', {})[key] = value
 
-# Custom JSON encoder for datetime objects
-class DateTimeEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, datetime):
-            return obj.isoformat()
-        return super().default(obj)
+def get_query_param(key: str):
+    """Read a query param, taking queued writes into account"""
+    pending = st.session_state.get('_pending_query_params', {})
+    if key in pending:
+        return pending[key]
+    return st.query_params.get(key)
+
+def flush_query_params():
+    """Apply all queued query param writes in a single update"""
+    pending = st.session_state.get('_pending_query_params')
+    if not pending:
+        return
+    
+    updates = {key: value for key, value in pending.items() if value is not None}
+    for key in pending.keys() - updates.keys():
+        if key in st.query_params:
+            del st.query_params[key]
+    if updates:
+        st.query_params.update(updates)
+    
+    pending.clear()
 
 # Storage functions using query params for auth persistence
-def save_auth_to_storage(email: str, auth_token: str):
-    """Save authentication to URL query params (persists across refreshes)"""
-    import base64
+def save_auth_to_storage(email: str):
+    """Save a signed authentication token to URL query params (persists across refreshes)"""
+    if get_auth_signing_key() is None:
+        return
+    
+    timestamp = datetime.now(LOCAL_TZ).isoformat(timespec='seconds')
     auth_data = {
         'email': email,
-        'token': auth_token,
-        'timestamp': datetime.now(LOCAL_TZ).isoformat()
+        'token': generate_auth_token(email, timestamp),
+        'timestamp': timestamp
     }
-    # Encode to base64
-    auth_json = json.dumps(auth_data)
-    auth_b64 = base64.b64encode(auth_json.encode()).decode()
+    # Encode to base64 (orjson returns bytes, so no extra encode step)
+    auth_b64 = base64.b64encode(orjson.dumps(auth_data)).decode()
     
     # Save to query params
-    try:
-        st.query_params["auth"] = auth_b64
-    except:
-        pass
+    set_query_param("auth", auth_b64)
 
 def load_auth_from_storage():
     """Load authentication from URL query params"""
-    import base64
     try:
-        if "auth" in st.query_params:
-            auth_b64 = st.query_params["auth"]
-            auth_json = base64.b64decode(auth_b64).decode()
-            auth_data = json.loads(auth_json)
+        auth_b64 = get_query_param("auth")
+        if auth_b64:
+            auth_data = orjson.loads(base64.b64decode(auth_b64))
             return auth_data
     except Exception as e:
-        print(f"Error loading auth: {e}")
+        logger.error("Error loading auth: %s", e)
         pass
     return None
 
 def clear_auth_from_storage():
     """Clear authentication from storage"""
+    set_query_param("auth", None)
+
+def mark_conversation_dirty(conversation_id: str):
+    """Flag a conversation as changed so its metadata is persisted at the end of the run"""
+    st.session_state.setdefault('_dirty_conv_ids', set()).add(conversation_id)
+
+# A bare updated_at bump is only written every few turns; transcripts are appended
+# immediately, and assessment state, title, summary, new and deleted conversations
+# are still saved at the end of the run (user_message_count is recounted on load)
+META_SAVE_INTERVAL = 5
+
+def note_conversation_turn(conversation_id: str):
+    """Count a chat turn, marking the conversation dirty every META_SAVE_INTERVAL turns"""
+    turns = st.session_state.setdefault('_turns_since_save', {})
+    turns[conversation_id] = turns.get(conversation_id, 0) + 1
+    if turns[conversation_id] >= META_SAVE_INTERVAL:
+        mark_conversation_dirty(conversation_id)
+
+def flush_conversations(include_pending_turns: bool = False):
+    """Persist the metadata of conversations changed during this script run"""
+    turns = st.session_state.get('_turns_since_save', {})
+    if include_pending_turns:
+        for conversation_id in turns:
+            mark_conversation_dirty(conversation_id)
+    
+    if st.session_state.get('_dirty_conv_ids') and st.session_state.get('user_email'):
+        for conversation_id in st.session_state._dirty_conv_ids:
+            save_conversation_metadata(conversation_id)
+            turns.pop(conversation_id, None)
+        st.session_state._dirty_conv_ids.clear()
+
+# Conversations are stored on disk, one directory per user with two files each:
+#   <conversation_id>.meta.json - metadata (everything except the messages)
+#   <conversation_id>.jsonl - append-only message transcript
+DATA_DIR = Path(__file__).parent / "user_data"
+
+@st.cache_resource(show_spinner=False)
+def get_user_storage_dir(user_email: str) -> Path:
+    """Get (and create, once per process) the storage directory for a user"""
+    # Hash of the normalized email: one directory per address regardless of case,
+    # and no two addresses can collide on an escaped name
+    dirname = hashlib.sha256(user_email.strip().lower().encode()).hexdigest()
+    storage_dir = DATA_DIR / dirname
+    storage_dir.mkdir(parents=True, exist_ok=True)
+    return storage_dir
+
+def get_conversation_file(conversation_id: str, suffix: str) -> Path:
+    """Path of one of a conversation's files, refusing anything outside the user's directory"""
+    storage_dir = get_user_storage_dir(st.session_state.user_email).resolve()
+    path = (storage_dir / f"{conversation_id}{suffix}").resolve()
+    if path.parent != storage_dir:
+        raise ValueError(f"Invalid conversation id: {conversation_id!r}")
+    return path
+
+def get_transcript_path(conversation_id: str) -> Path:
+    """Path of a conversation's message transcript for the logged in user"""
+    return get_conversation_file(conversation_id, ".jsonl")
+
+def get_metadata_path(conversation_id: str) -> Path:
+    """Path of a conversation's metadata file for the logged in user"""
+    return get_conversation_file(conversation_id, ".meta.json")
+
+def write_in_storage_dir(path: Path, write):
+    """Run a write, recreating the storage directory if it was removed since it was cached"""
     try:
-        if "auth" in st.query_params:
-            del st.query_params["auth"]
-    except:
-        pass
+        write()
+    except FileNotFoundError:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        write()
 
-def save_conversations_to_storage():
-    """Save conversations to session state and query params"""
-    import base64
+def append_message_to_storage(conversation_id: str, message: dict):
+    """Append a single message to the conversation's transcript"""
+    def append():
+        with open(path, 'ab') as f:
+            f.write(orjson.dumps(message) + b"\n")
     try:
-        # Serialize conversations
-        conv_json = json.dumps(st.session_state.conversations, cls=DateTimeEncoder)
-        conv_b64 = base64.b64encode(conv_json.encode()).decode()
-        
-        # Save to query params (this persists across refreshes)
-        st.query_params["conv"] = conv_b64
+        path = get_transcript_path(conversation_id)
+        write_in_storage_dir(path, append)
+    except Exception as e:
+        logger.error("Error saving message: %s", e)
+
+def write_transcript(conversation_id: str, messages: list):
+    """Rewrite a conversation's whole transcript (used when importing or migrating)"""
+    def rewrite():
+        with open(path, 'wb') as f:
+            f.writelines(orjson.dumps(message) + b"\n" for message in messages)
+    try:
+        path = get_transcript_path(conversation_id)
+        write_in_storage_dir(path, rewrite)
+    except Exception as e:
+        logger.error("Error saving transcript: %s", e)
+
+def read_transcript(conversation_id: str) -> list:
+    """Read a conversation's messages from its transcript, skipping undecodable lines"""
+    try:
+        path = get_transcript_path(conversation_id)
+        if not path.exists():
+            return []
+        data = path.read_bytes()
+    except Exception as e:
+        logger.error("Error loading transcript: %s", e)
+        return []
+    
+    messages = []
+    offset = 0
+    for line in data.splitlines(keepends=True):
+        try:
+            if line.strip():
+                messages.append(orjson.loads(line))
+        except orjson.JSONDecodeError:
+            if offset + len(line) == len(data):
+                # Torn last line from a crash mid-append: cut it off so the next
+                # append starts on a clean line
+                logger.warning("Truncating torn last line of transcript %s", conversation_id)
+                truncate_transcript(path, offset)
+            else:
+                logger.warning("Skipping undecodable line in transcript %s", conversation_id)
+        offset += len(line)
+    return messages
+
+def truncate_transcript(path: Path, size: int):
+    """Cut a transcript back to its last complete line"""
+    try:
+        with open(path, 'r+b') as f:
+            f.truncate(size)
+    except Exception as e:
+        logger.error("Error truncating transcript: %s", e)
+
+def delete_conversation_files(conversation_id: str):
+    """Remove a conversation's metadata and transcript from disk"""
+    try:
+        get_metadata_path(conversation_id).unlink(missing_ok=True)
+        get_transcript_path(conversation_id).unlink(missing_ok=True)
+    except Exception as e:
+        logger.error("Error deleting conversation: %s", e)
+
+def save_conversation_metadata(conversation_id: str):
+    """Write one conversation's metadata (messages live in the transcript)"""
+    conv = st.session_state.conversations.get(conversation_id)
+    if conv is None:
+        # Deleted during this run, its files are already gone
+        return
+    try:
+        meta = {key: value for key, value in conv.items() if key != 'messages'}
+        path = get_metadata_path(conversation_id)
+        # Write to a temp file and swap it in so a crash never leaves a half-written file
+        tmp_path = path.with_name(path.name + ".tmp")
+        write_in_storage_dir(tmp_path, lambda: tmp_path.write_bytes(orjson.dumps(meta)))
+        os.replace(tmp_path, path)
     except Exception as e:
-        print(f"Error saving conversations: {e}")
+        logger.error("Error saving conversation: %s", e)
 
 def load_conversations_from_storage():
-    """Load conversations from query params"""
-    import base64
+    """Load the logged in user's conversation metadata (transcripts are loaded on demand)"""
     try:
-        if "conv" in st.query_params:
-            conv_b64 = st.query_params["conv"]
-            conv_json = base64.b64decode(conv_b64).decode()
-            conversations = json.loads(conv_json)
-            
-            # Parse datetime strings back to datetime objects
-            return parse_datetime_in_dict(conversations)
+        conversations = {}
+        for meta_path in get_user_storage_dir(st.session_state.user_email).glob("*.meta.json"):
+            conv_id = meta_path.name[:-len(".meta.json")]
+            conversations[conv_id] = orjson.loads(meta_path.read_bytes())
+        
+        # Conversations are never read from the URL (a crafted link could plant them),
+        # so just clear any blob left over from the old URL storage
+        if get_query_param("conv"):
+            set_query_param("conv", None)
+        return conversations
     except Exception as e:
-        print(f"Error loading conversations: {e}")
+        logger.error("Error loading conversations: %s", e)
     return {}
 
-def parse_datetime_in_dict(obj):
-    """Recursively parse ISO datetime strings back to datetime objects"""
-    if isinstance(obj, dict):
-        return {k: parse_datetime_in_dict(v) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [parse_datetime_in_dict(item) for item in obj]
-    elif isinstance(obj, str):
-        # Try to parse ISO datetime strings
+def now_ts() -> int:
+    """Current time as epoch seconds, the format timestamps are stored in"""
+    return int(time.time())
+
+def to_dt(ts: int) -> datetime:
+    """Convert a stored epoch-seconds timestamp to a local datetime for display"""
+    return datetime.fromtimestamp(ts, LOCAL_TZ)
+
+def format_message_time(ts: int = None) -> str:
+    """Format a stored timestamp (or the current time) as HH:MM local time"""
+    return (to_dt(ts) if ts is not None else datetime.now(LOCAL_TZ)).strftime("%H:%M")
+
+def _to_epoch(value) -> int:
+    """Convert a legacy ISO string or datetime timestamp to epoch seconds"""
+    if isinstance(value, str):
         try:
-            # Check if it looks like an ISO datetime
-            if 'T' in obj and ('-' in obj or ':' in obj):
-                dt = datetime.fromisoformat(obj.replace('Z', '+00:00'))
-                return dt
-        except:
-            pass
-    return obj
+            value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            return now_ts()
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=LOCAL_TZ)
+    return int(value.timestamp())
 
 def init_session_state():
     """Initialize session state variables"""
-    if 'conversations' not in st.session_state:
-        # Try to load from storage first
-        stored_conversations = load_conversations_from_storage()
-        st.session_state.conversations = stored_conversations if stored_conversations else {}
-    
-    # Migrate existing conversations to add missing fields
-    migrate_conversations()
-    
-    if 'current_conversation_id' not in st.session_state:
+    st.session_state.setdefault('current_conversation_id', None)
+    st.session_state.setdefault('patient_info', {"age": 35, "gender": "Male"})
+    st.session_state.setdefault('assessment_state', {})
+    st.session_state.setdefault('otp_sent', False)
+    st.session_state.setdefault('otp_code', None)
+    st.session_state.setdefault('otp_email', None)
+    st.session_state.setdefault('otp_expires_at', 0)
+    st.session_state.setdefault('otp_attempts', 0)
+    st.session_state.setdefault('authenticated', False)
+    st.session_state.setdefault('user_email', None)
+
+def init_conversations():
+    """Load the logged in user's conversations into session state (once per login)"""
+    user_email = st.session_state.user_email
+    if st.session_state.get('_loaded_email') != user_email:
+        st.session_state.conversations = load_conversations_from_storage()
         st.session_state.current_conversation_id = None
-    
-    if 'patient_info' not in st.session_state:
-        st.session_state.patient_info = {"age": 35, "gender": "Male"}
-    
-    if 'assessment_state' not in st.session_state:
         st.session_state.assessment_state = {}
-    
-    if 'otp_sent' not in st.session_state:
-        st.session_state.otp_sent = False
-    
-    if 'otp_code' not in st.session_state:
-        st.session_state.otp_code = None
-    
-    if 'otp_email' not in st.session_state:
-        st.session_state.otp_email = None
-    
-    if 'authenticated' not in st.session_state:
-        st.session_state.authenticated = False
-    
-    if 'user_email' not in st.session_state:
-        st.session_state.user_email = None
+        
+        # Migrate existing conversations to add missing fields
+        migrate_conversations()
+        
+        # Keep conversations ordered most recently updated first
+        st.session_state.conversations = OrderedDict(sorted(
+            st.session_state.conversations.items(),
+            key=lambda item: item[1]['updated_at'],
+            reverse=True
+        ))
+        st.session_state._loaded_email = user_email
     
     # Auto-create first conversation if none exist
     if not st.session_state.conversations:
         create_new_conversation()
 
+# Bump whenever migrate_conversations gains a new step
+SCHEMA_VERSION = 3
+
 def migrate_conversations():
     """Migrate existing conversations to add missing fields"""
-    now = datetime.now(LOCAL_TZ)
-    needs_save = False
+    now = now_ts()
     
     for conv_id, conv in st.session_state.conversations.items():
+        # Skip conversations stored at the current schema
+        if conv.get('_v') == SCHEMA_VERSION:
+            continue
+        
         # Add missing created_at
         if 'created_at' not in conv:
             conv['created_at'] = now
-            needs_save = True
         
         # Add missing updated_at
         if 'updated_at' not in conv:
             conv['updated_at'] = conv.get('created_at', now)
-            needs_save = True
         
         # Add missing title
         if 'title' not in conv:
             conv['title'] = f"Conversation {conv_id[:8]}"
-            needs_save = True
-        
-        # Add missing messages
-        if 'messages' not in conv:
-            conv['messages'] = []
-            needs_save = True
         
-        # Add missing assessment_state
-        if 'assessment_state' not in conv:
-            conv['assessment_state'] = {}
-            needs_save = True
+        # Make sure the messages are in memory before upgrading them
+        ensure_messages_loaded(conv_id, conv)
         
         # Add missing session_id
         if 'session_id' not in conv:
             conv['session_id'] = str(uuid.uuid4())
-            needs_save = True
         
         # Add missing state (for API compatibility)
         if 'state' not in conv:
             conv['state'] = conv.get('assessment_state', {})
-            needs_save = True
+        
+        # 'state' is the only stored copy of the assessment
+        conv.pop('assessment_state', None)
+        
+        # Add missing user message count
+        if 'user_message_count' not in conv:
+            conv['user_message_count'] = sum(1 for m in conv['messages'] if m['role'] == 'user')
         
         # Add missing summary
         if 'summary' not in conv:
             conv['summary'] = ""
-            needs_save = True
-    
-    # Save if we made any changes
-    if needs_save:
-        save_conversations_to_storage()
+        
+        # Convert legacy ISO/datetime timestamps to epoch seconds
+        for key in ('created_at', 'updated_at'):
+            if not isinstance(conv[key], int):
+                conv[key] = _to_epoch(conv[key])
+        for message in conv['messages']:
+            if 'timestamp' in message and not isinstance(message['timestamp'], int):
+                message['timestamp'] = _to_epoch(message['timestamp'])
+        
+        conv['_v'] = SCHEMA_VERSION
+        write_transcript(conv_id, conv['messages'])
+        mark_conversation_dirty(conv_id)
+
+
+@st.cache_resource(show_spinner=False)
+def get_auth_signing_key():
+    """Key used to sign auth tokens, read from secrets once per process (None if not configured)"""
+    try:
+        secret_key = st.secrets["SECRET_KEY"]
+    except Exception:
+        secret_key = None
+    if not secret_key:
+        # No fallback key: a publicly known one would let anyone forge a login
+        logger.warning("SECRET_KEY is not configured; logins won't persist across refreshes")
+        return None
+    return secret_key.encode()
 
+def generate_auth_token(email: str, timestamp: str) -> str:
+    """Generate a secure auth token (HMAC-SHA256 of email and login time keyed with SECRET_KEY)"""
+    return hmac.new(get_auth_signing_key(), f"{email}:{timestamp}".encode(), hashlib.sha256).hexdigest()
 
-def generate_auth_token(email: str) -> str:
-    """Generate a secure auth token"""
-    timestamp = datetime.now(LOCAL_TZ).isoformat()
-    token_string = f"{email}:{timestamp}:{st.secrets.get('SECRET_KEY', 'default-secret')}"
-    return hashlib.sha256(token_string.encode()).hexdigest()
+def is_auth_token_valid(auth_data: dict) -> bool:
+    """Check a stored token against its email and timestamp in constant time"""
+    token = auth_data.get('token')
+    if not isinstance(token, str) or get_auth_signing_key() is None:
+        return False
+    expected = generate_auth_token(auth_data['email'], str(auth_data.get('timestamp', '')))
+    return hmac.compare_digest(expected, token)
+
+def create_http_session() -> requests.Session:
+    """HTTP session whose requests reuse pooled TLS connections"""
+    session = requests.Session()
+    # Retry connection errors and gateway errors (status retries only apply to idempotent requests)
+    retries = Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+    session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=8, max_retries=retries))
+    return session
+
+@st.cache_resource(show_spinner=False)
+def get_http_session() -> requests.Session:
+    """Shared HTTP session for the Google OAuth calls"""
+    return create_http_session()
 
 # Google Sign-In functionality
+@st.cache_resource(show_spinner=False)
 def get_redirect_uri():
     """Get the appropriate redirect URI based on environment"""
     try:
@@ -338,10 +447,6 @@ def get_redirect_uri():
     
     # Auto-detect based on current URL
     try:
-        # Try to get the current host from Streamlit
-        import streamlit.web.bootstrap as bootstrap
-        from streamlit import runtime
-        
         # Check if running locally
         if runtime.exists():
             # Get the browser's current URL if available
@@ -353,11 +458,10 @@ def get_redirect_uri():
     # Default fallback
     return "http://localhost:8501/"
 
+@st.cache_resource(show_spinner=False)
 def get_google_oauth_url():
     """Generate Google OAuth URL for authentication"""
     try:
-        from urllib.parse import urlencode
-        
         client_id = st.secrets["google_client_id"]
         redirect_uri = get_redirect_uri()
         
@@ -380,8 +484,6 @@ def get_google_oauth_url():
 def exchange_code_for_token(code: str):
     """Exchange authorization code for user info"""
     try:
-        import requests
-        
         client_id = st.secrets["google_client_id"]
         client_secret = st.secrets["google_client_secret"]
         redirect_uri = get_redirect_uri()
@@ -396,7 +498,7 @@ def exchange_code_for_token(code: str):
             "grant_type": "authorization_code"
         }
         
-        token_response = requests.post(token_url, data=token_data)
+        token_response = get_http_session().post(token_url, data=token_data)
         token_json = token_response.json()
         
         if "access_token" in token_json:
@@ -405,7 +507,7 @@ def exchange_code_for_token(code: str):
             userinfo_url = "https://www.googleapis.com/oauth2/v2/userinfo"
             headers = {"Authorization": f"Bearer {access_token}"}
             
-            user_response = requests.get(userinfo_url, headers=headers)
+            user_response = get_http_session().get(userinfo_url, headers=headers)
             user_info = user_response.json()
             
             return user_info
@@ -429,13 +531,10 @@ def render_google_signin_button():
             email = user_info["email"]
             
             # Check if email is authorized
-            authorized_emails = st.secrets.get("AUTHORIZED_EMAILS", "").split(",")
+            authorized_emails = st.secrets.get("AUTHORIZED_EMAILS", "")
             if is_email_authorized(email, authorized_emails):
-                # Generate auth token
-                auth_token = generate_auth_token(email)
-                
-                # Save to storage
-                save_auth_to_storage(email, auth_token)
+                # Save a signed auth token to storage
+                save_auth_to_storage(email)
                 
                 # Set session state
                 st.session_state.authenticated = True
@@ -462,7 +561,6 @@ def render_google_signin_button():
             
             # Show current app URL
             try:
-                import socket
                 hostname = socket.gethostname()
                 st.info(f"🔗 **Your current app URL might be:** `https://{hostname}/`")
             except:
@@ -617,12 +715,18 @@ def render_google_signin_button():
 # API configuration
 API_BASE_URL = st.secrets.get("API_BASE_URL", "https://dbc-e469a72f-3a02.cloud.databricks.com/serving-endpoints/agents_gen_ai-ai_triage-ai_triage_langgraph_v4")
 DATABRICKS_TOKEN = st.secrets.get("DATABRICKS_TOKEN", "your_token_here")
+# (connect, read) timeouts in seconds - the agent can take a while to answer
+API_TIMEOUT = (5, 60)
 
-def call_api(user_message: str, session_id: str, generate_summary: bool = False) -> dict:
-    """Call the AI agent API using Databricks serving endpoint format"""
-    headers = {"Content-Type": "application/json"}
-    auth = ("token", DATABRICKS_TOKEN)
-    
+@st.cache_resource(show_spinner=False)
+def get_api_session() -> requests.Session:
+    """Shared HTTP session for the agent endpoint, with the Databricks token attached once"""
+    session = create_http_session()
+    session.auth = ("token", DATABRICKS_TOKEN)
+    return session
+
+def build_api_payload(user_message: str, session_id: str, generate_summary: bool = False) -> dict:
+    """Build the request body for the Databricks serving endpoint"""
     payload = {
         "messages": [{"role": "user", "content": user_message}],
         "custom_inputs": {
@@ -636,63 +740,160 @@ def call_api(user_message: str, session_id: str, generate_summary: bool = False)
     if generate_summary:
         payload["custom_inputs"]["generate_summary"] = True
     
-    try:
-        start_time = datetime.now(LOCAL_TZ)
-        url = f"{API_BASE_URL}/invocations"
-        response = requests.post(url, json=payload, headers=headers, auth=auth)
-        response.raise_for_status()
+    return payload
+
+def post_api_payload(session: requests.Session, payload: dict) -> dict:
+    """POST a payload to the agent endpoint (no Streamlit calls, safe off the script thread)"""
+    start_time = time.perf_counter()
+    url = f"{API_BASE_URL}/invocations"
+    # json= already sets the Content-Type header
+    response = session.post(url, json=payload, timeout=API_TIMEOUT)
+    response.raise_for_status()
+    
+    latency = time.perf_counter() - start_time
+    
+    result = response.json()
+    result["_latency"] = round(latency, 2)
+    
+    return result
+
+@st.cache_resource(show_spinner=False)
+def get_api_executor() -> ThreadPoolExecutor:
+    """Background workers for chat replies and auto-generated summaries"""
+    # Shared by every session and mostly waiting on the network (up to API_TIMEOUT per call),
+    # so size it for concurrent users rather than CPUs
+    return ThreadPoolExecutor(max_workers=int(st.secrets.get("API_MAX_WORKERS", 32)))
+
+def start_reply_generation(conversation: dict, user_message: str):
+    """Send a chat message to the agent in the background without blocking the UI"""
+    payload = build_api_payload(user_message, conversation["session_id"])
+    pending = st.session_state.setdefault('_pending_replies', {})
+    pending[conversation['id']] = get_api_executor().submit(post_api_payload, get_api_session(), payload)
+
+def collect_pending_replies() -> bool:
+    """Process any finished background chat replies; returns True if one arrived"""
+    pending = st.session_state.get('_pending_replies', {})
+    collected = False
+    
+    for conversation_id, future in list(pending.items()):
+        if not future.done():
+            continue
+        del pending[conversation_id]
+        collected = True
+        
+        try:
+            response = future.result()
+        except Exception as e:
+            st.error(f"API Error: {str(e)}")
+            st.error("Failed to get response from AI")
+            continue
         
-        end_time = datetime.now(LOCAL_TZ)
-        latency = (end_time - start_time).total_seconds()
+        conversation = st.session_state.conversations.get(conversation_id)
+        if conversation is not None:
+            ensure_messages_loaded(conversation_id, conversation)
+            process_response(response, conversation_id)
+    
+    return collected
+
+@st.fragment(run_every=0.5)
+def poll_pending_replies():
+    """Show a thinking indicator and rerun the app once any pending reply has arrived"""
+    pending = st.session_state.get('_pending_replies', {})
+    if not pending or any(future.done() for future in pending.values()):
+        st.rerun()
+    if st.session_state.current_conversation_id in pending:
+        st.caption("🤔 Thinking...")
+
+def start_summary_generation(conversation: dict):
+    """Request a conversation summary in the background without blocking the UI"""
+    pending = st.session_state.setdefault('_pending_summary_futures', {})
+    if conversation['id'] in pending:
+        return
+    
+    payload = build_api_payload("Generate summary for this conversation.", conversation["session_id"], generate_summary=True)
+    pending[conversation['id']] = get_api_executor().submit(post_api_payload, get_api_session(), payload)
+
+def collect_pending_summaries() -> bool:
+    """Store any finished background summaries; returns True if any request finished"""
+    pending = st.session_state.get('_pending_summary_futures', {})
+    collected = False
+    
+    for conversation_id, future in list(pending.items()):
+        if not future.done():
+            continue
+        del pending[conversation_id]
+        # Failed or empty results count too, so the poller stops
+        collected = True
         
-        result = response.json()
-        result["_latency"] = round(latency, 2)
+        try:
+            response = future.result()
+        except Exception as e:
+            logger.error("Error generating summary: %s", e)
+            continue
         
-        return result
-    except Exception as e:
-        st.error(f"API Error: {str(e)}")
-        return None
+        conversation = st.session_state.conversations.get(conversation_id)
+        if conversation and response.get("messages"):
+            conversation["summary"] = response["messages"][0].get("content", "")
+            mark_conversation_dirty(conversation_id)
+    
+    return collected
+
+@st.fragment(run_every=1)
+def poll_pending_summaries():
+    """Rerun the app once a background summary request has finished"""
+    if collect_pending_summaries():
+        st.rerun()
+    st.caption("📝 Auto-generating summary...")
+
+# Email format validation
+EMAIL_RE = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
 
 def is_valid_email(email: str) -> bool:
     """Validate email format"""
-    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    return re.match(pattern, email) is not None
+    return EMAIL_RE.match(email) is not None
 
-def is_email_authorized(email: str, authorized_list: list) -> bool:
-    """Check if email or domain is authorized"""
-    email = email.strip().lower()
-    
-    for authorized in authorized_list:
+@st.cache_resource(show_spinner=False)
+def parse_authorized_emails(authorized_emails: str) -> tuple:
+    """Split the AUTHORIZED_EMAILS setting into exact emails and bare @domain names"""
+    exact, domains = set(), set()
+    for authorized in authorized_emails.split(','):
         authorized = authorized.strip().lower()
-        
-        # Check for exact email match
-        if email == authorized:
-            return True
-        
-        # Check for domain match (e.g., @company.com)
         if authorized.startswith('@'):
-            email_domain = '@' + email.split('@')[1] if '@' in email else ''
-            if email_domain == authorized:
-                return True
+            domains.add(authorized[1:])
+        elif authorized:
+            exact.add(authorized)
+    return frozenset(exact), frozenset(domains)
+
+def is_email_authorized(email: str, authorized_emails: str) -> bool:
+    """Check if email or domain is authorized"""
+    exact, domains = parse_authorized_emails(authorized_emails)
+    email = email.strip().lower()
     
-    return False
+    # Exact email match, or domain match (e.g., @company.com)
+    return email in exact or email.rpartition('@')[2] in domains
+
+# Sign-in codes expire after OTP_TTL seconds or OTP_MAX_ATTEMPTS wrong guesses
+OTP_TTL = 600
+OTP_MAX_ATTEMPTS = 5
 
 def generate_otp() -> str:
     """Generate a 6-digit OTP"""
-    return ''.join([str(random.randint(0, 9)) for _ in range(6)])
+    return f"{secrets.randbelow(1_000_000):06d}"
 
 def send_otp_email(email: str, otp: str):
     """Send OTP via email (demo mode - would integrate with email service in production)"""
     # In production, this would use SendGrid, AWS SES, or similar
-    print(f"[DEMO MODE] Sending OTP {otp} to {email}")
-    # For demo purposes, we just display it in the UI
+    # Never shown in the UI: the code proves the user can read this mailbox
+    logger.warning("[DEMO MODE] Sending OTP %s to %s", otp, email)
     return True
 
-def generate_auth_token(email: str) -> str:
-    """Generate a secure auth token"""
-    timestamp = datetime.now(LOCAL_TZ).isoformat()
-    token_string = f"{email}:{timestamp}:{st.secrets.get('SECRET_KEY', 'default-secret')}"
-    return hashlib.sha256(token_string.encode()).hexdigest()
+def reset_otp():
+    """Forget any outstanding sign-in code"""
+    st.session_state.otp_sent = False
+    st.session_state.otp_code = None
+    st.session_state.otp_email = None
+    st.session_state.otp_expires_at = 0
+    st.session_state.otp_attempts = 0
 
 def create_new_conversation():
     """Create a new conversation with initial template message"""
@@ -700,54 +901,75 @@ def create_new_conversation():
     session_id = str(uuid.uuid4())
     initial_message = "Hi, I'm your AI Triage Chatbot. I'm here to discuss your symptoms and help guide you to the next appropriate care option. Could you please describe any symptoms you are experiencing?"
     
-    now = datetime.now(LOCAL_TZ)
+    now = now_ts()
+    greeting = {"role": "assistant", "content": initial_message, "timestamp": now, "ts_display": format_message_time(now), "latency": None}
     
     st.session_state.conversations[conversation_id] = {
         'id': conversation_id,
         'session_id': session_id,
         'title': f"Conversation {len(st.session_state.conversations) + 1}",
-        'messages': [{"role": "assistant", "content": initial_message, "timestamp": now, "latency": None}],
+        'messages': [greeting],
         'created_at': now,
         'updated_at': now,
         'state': {},
         'summary': "",
-        'assessment_state': {}
+        'user_message_count': 0,
+        '_v': SCHEMA_VERSION
     }
     
+    st.session_state.conversations.move_to_end(conversation_id, last=False)
     st.session_state.current_conversation_id = conversation_id
     st.session_state.assessment_state = {}
     
-    # Save to storage
-    save_conversations_to_storage()
+    write_transcript(conversation_id, [greeting])
+    mark_conversation_dirty(conversation_id)
     
     return conversation_id
 
+def ensure_messages_loaded(conversation_id: str, conversation: dict):
+    """Read a conversation's transcript from disk the first time it is needed"""
+    if 'messages' not in conversation:
+        conversation['messages'] = read_transcript(conversation_id)
+        # The stored count can lag behind the transcript between metadata saves
+        conversation['user_message_count'] = sum(1 for m in conversation['messages'] if m['role'] == 'user')
+
 def get_current_conversation():
-    """Get the current conversation"""
+    """Get the current conversation, loading its messages if needed"""
     if not st.session_state.current_conversation_id:
         return None
-    return st.session_state.conversations.get(st.session_state.current_conversation_id)
+    conversation = st.session_state.conversations.get(st.session_state.current_conversation_id)
+    if conversation is not None:
+        ensure_messages_loaded(st.session_state.current_conversation_id, conversation)
+    return conversation
+
+def get_assessment_state(conversation: dict) -> dict:
+    """Get the assessment data (API custom_outputs) stored on a conversation"""
+    return conversation.get('state', {})
 
 def update_conversation_title(conversation_id: str, first_message: str):
     """Update conversation title based on first message"""
     if conversation_id in st.session_state.conversations:
         # Use first 50 characters of first message as title
-        title = first_message[:50] + "..." if len(first_message) > 50 else first_message
+        title = first_message if len(first_message) <= 50 else f"{first_message[:50]}..."
         st.session_state.conversations[conversation_id]['title'] = title
-        save_conversations_to_storage()
+        mark_conversation_dirty(conversation_id)
 
 def delete_conversation(conversation_id: str):
     """Delete a conversation"""
     if conversation_id in st.session_state.conversations:
         del st.session_state.conversations[conversation_id]
+        st.session_state.get('_assessment_markdown', {}).pop(conversation_id, None)
+        delete_conversation_files(conversation_id)
         
         if st.session_state.current_conversation_id == conversation_id:
-            st.session_state.current_conversation_id = None
-            st.session_state.assessment_state = {}
+            # Fall back to the most recent remaining conversation (first key, O(1))
+            next_id = next(iter(st.session_state.conversations), None)
+            st.session_state.current_conversation_id = next_id
+            st.session_state.assessment_state = get_assessment_state(st.session_state.conversations[next_id]) if next_id else {}
         
-        save_conversations_to_storage()
+        mark_conversation_dirty(conversation_id)
 
-def process_response(response: dict, conversation_id: str, summary=False):
+def process_response(response: dict, conversation_id: str):
     """Process the API response and update conversation state"""
     if not response:
         st.warning("No response received from API")
@@ -765,67 +987,70 @@ def process_response(response: dict, conversation_id: str, summary=False):
         assistant_message = "I apologize, but I couldn't process that response."
     
     latency = response.get("_latency", None)
-    
-    # Add assistant message with local timezone
-    if not summary:
-        conversation["messages"].append({
-            "role": "assistant",
-            "content": assistant_message,
-            "timestamp": datetime.now(LOCAL_TZ),
-            "latency": latency
-        })
-        
-        # Extract assessment data from custom_outputs field
-        if "custom_outputs" in response:
-            assessment_data = response["custom_outputs"]
-            conversation["state"] = assessment_data
-            st.session_state.assessment_state = assessment_data
-        else:
-            st.warning("⚠️ DEBUG - No 'custom_outputs' field in API response")
-    
-        # Automatically generate summary when result is no longer pending
-        result_status = (conversation["state"].get("result") or "").lower() if conversation["state"].get("result") is not None else "pending"
-        if result_status and result_status != "pending" and not conversation.get("summary"):
-            with st.spinner("Auto-generating summary..."):
-                response = call_api("Generate summary for this conversation.", conversation["session_id"], generate_summary=True)
-                if response:
-                    conversation["summary"] = response["messages"][0].get("content", "")
-    
-        # Update conversation timestamp
-        conversation['updated_at'] = datetime.now(LOCAL_TZ)
+    now = now_ts()
+    
+    # Add assistant message
+    message = {
+        "role": "assistant",
+        "content": assistant_message,
+        "timestamp": now,
+        "ts_display": format_message_time(now),
+        "latency": latency
+    }
+    conversation["messages"].append(message)
+    append_message_to_storage(conversation_id, message)
+    
+    # Extract assessment data from custom_outputs field
+    if "custom_outputs" in response:
+        assessment_data = response["custom_outputs"]
+        conversation["state"] = assessment_data
+        st.session_state.assessment_state = assessment_data
+        set_assessment_markdown(conversation_id, assessment_data)
+        mark_conversation_dirty(conversation_id)
     else:
-        conversation["summary"] = assistant_message
+        st.warning("⚠️ DEBUG - No 'custom_outputs' field in API response")
     
-    save_conversations_to_storage()
+    # Automatically generate summary when result is no longer pending
+    result_status = (conversation["state"].get("result") or "").lower() if conversation["state"].get("result") is not None else "pending"
+    if result_status and result_status != "pending" and not conversation.get("summary"):
+        start_summary_generation(conversation)
     
-    st.success("✅ Response processed successfully")
+    # Update conversation timestamp and move it to the top of the list
+    conversation['updated_at'] = now
+    st.session_state.conversations.move_to_end(conversation_id, last=False)
+    note_conversation_turn(conversation_id)
+
+@st.fragment
+def render_patient_info():
+    """Patient info controls (as a fragment, moving the slider doesn't rerun the chat)"""
+    with st.expander("👤 Patient Info", expanded=True):
+        # Age slider with auto-update
+        age = st.slider(
+            "Age", 
+            min_value=0, 
+            max_value=120, 
+            value=st.session_state.patient_info["age"]
+        )
+        
+        # Gender selection with auto-update
+        gender_options = ["Male", "Female", "Other"]
+        current_gender_index = gender_options.index(st.session_state.patient_info["gender"]) if st.session_state.patient_info["gender"] in gender_options else 0
+        gender = st.selectbox(
+            "Gender", 
+            gender_options,
+            index=current_gender_index
+        )
+        
+        # Auto-update patient info if values changed
+        if age != st.session_state.patient_info["age"] or gender != st.session_state.patient_info["gender"]:
+            st.session_state.patient_info = {"age": age, "gender": gender}
+            st.success("✅ Patient info updated!")
 
 def render_mobile_sidebar():
     """Render mobile-friendly sidebar"""
     with st.sidebar:
         # Patient Info Section - Auto-updates on change
-        with st.expander("👤 Patient Info", expanded=True):
-            # Age slider with auto-update
-            age = st.slider(
-                "Age", 
-                min_value=0, 
-                max_value=120, 
-                value=st.session_state.patient_info["age"]
-            )
-            
-            # Gender selection with auto-update
-            gender_options = ["Male", "Female", "Other"]
-            current_gender_index = gender_options.index(st.session_state.patient_info["gender"]) if st.session_state.patient_info["gender"] in gender_options else 0
-            gender = st.selectbox(
-                "Gender", 
-                gender_options,
-                index=current_gender_index
-            )
-            
-            # Auto-update patient info if values changed
-            if age != st.session_state.patient_info["age"] or gender != st.session_state.patient_info["gender"]:
-                st.session_state.patient_info = {"age": age, "gender": gender}
-                st.success("✅ Patient info updated!")
+        render_patient_info()
         
         st.markdown("---")
         
@@ -841,186 +1066,102 @@ def render_mobile_sidebar():
         
         st.markdown("---")
         
-        # List conversations (most recent first)
-        # Fix: Handle missing updated_at field
-        sorted_convs = sorted(
-            st.session_state.conversations.values(),
-            key=lambda x: x.get('updated_at', datetime.now(LOCAL_TZ)),
-            reverse=True
-        )
-        
-        for conv in sorted_convs:
-            is_current = conv['id'] == st.session_state.current_conversation_id
-            
-            # Conversation item
-            col1, col2 = st.columns([4, 1])
+        # Conversation list as a single radio (already kept most recent first)
+        conversations = st.session_state.conversations
+        if conversations:
+            conv_ids = list(conversations)
+            current_id = st.session_state.current_conversation_id
+            selected_id = st.radio(
+                "Conversations",
+                options=conv_ids,
+                index=conv_ids.index(current_id) if current_id in conversations else None,
+                format_func=lambda conv_id: conversations[conv_id].get('title', 'Untitled Conversation'),
+                captions=[f"📅 {to_dt(conv['updated_at']).strftime('%b %d, %I:%M %p')}" for conv in conversations.values()],
+                label_visibility="collapsed"
+            )
             
-            with col1:
-                button_type = "primary" if is_current else "secondary"
-                if st.button(
-                    conv.get('title', 'Untitled Conversation'),
-                    key=f"conv_{conv['id']}",
-                    use_container_width=True,
-                    type=button_type
-                ):
-                    st.session_state.current_conversation_id = conv['id']
-                    # Load assessment state for this conversation (use 'state' field which contains assessment data)
-                    st.session_state.assessment_state = conv.get('state', conv.get('assessment_state', {}))
-                    st.rerun()
+            if selected_id is not None and selected_id != current_id:
+                st.session_state.current_conversation_id = selected_id
+                # Load assessment state for this conversation (use 'state' field which contains assessment data)
+                st.session_state.assessment_state = get_assessment_state(conversations[selected_id])
+                st.rerun()
             
-            with col2:
-                if st.button("🗑️", key=f"del_{conv['id']}", use_container_width=True):
-                    delete_conversation(conv['id'])
+            # One delete control for the selected conversation
+            if current_id in conversations:
+                if st.button("🗑️ Delete Conversation", use_container_width=True):
+                    delete_conversation(current_id)
                     st.rerun()
-            
-            # Show last updated time
-            updated_time = conv.get('updated_at', conv.get('created_at'))
-            if updated_time:
-                if isinstance(updated_time, str):
-                    try:
-                        updated_time = datetime.fromisoformat(updated_time)
-                    except:
-                        pass
-                
-                if isinstance(updated_time, datetime):
-                    time_str = updated_time.strftime("%b %d, %I:%M %p")
-                    st.caption(f"📅 {time_str}")
-            
-            st.markdown("")
 
-def render_custom_chat(conversation):
-    """Render chat with custom CSS (original look and feel)"""
-    chat_messages_html = ""
-    
-    for message in conversation.get("messages", []):
-        # Format timestamp in local timezone
-        if "timestamp" in message:
-            if isinstance(message["timestamp"], str):
-                # Parse ISO format string
-                timestamp = datetime.fromisoformat(message["timestamp"])
-            else:
-                timestamp = message["timestamp"]
-            
-            # Ensure timezone aware
-            if timestamp.tzinfo is None:
-                timestamp = LOCAL_TZ.localize(timestamp)
-            else:
-                timestamp = timestamp.astimezone(LOCAL_TZ)
-            
-            timestamp_str = timestamp.strftime("%H:%M")
-        else:
-            timestamp_str = datetime.now(LOCAL_TZ).strftime("%H:%M")
-        
-        if message["role"] == "user":
-            chat_messages_html += f"""
-            <div class="message-container">
-                <div class="user-message">
-                    {message["content"]}
-                </div>
-                <div class="user-timestamp">
-                    {timestamp_str}
-                </div>
-            </div>
-            """
-        else:
-            latency_text = ""
-            if "latency" in message and message["latency"] is not None:
-                latency_text = f" • {message['latency']}s"
-            
-            chat_messages_html += f"""
-            <div class="message-container">
-                <div class="assistant-message">
-                    {message["content"]}
-                </div>
-                <div class="assistant-timestamp">
-                    {timestamp_str}{latency_text}
-                </div>
-            </div>
-            """
-    
-    # Display chat with original custom CSS
-    st.components.v1.html(f"""
-    <style>
-    .user-message {{
-        background-color: #007BFF;
-        color: white;
-        padding: 10px 15px;
-        border-radius: 18px;
-        margin: 5px 0;
-        margin-left: 20%;
-        text-align: right;
-        max-width: 70%;
-        float: right;
-        clear: both;
-        margin-bottom: 2px;
-    }}
-    
-    .assistant-message {{
-        background-color: #F1F1F1;
-        color: black;
-        padding: 10px 15px;
-        border-radius: 18px;
-        margin: 5px 0;
-        margin-right: 20%;
-        max-width: 70%;
-        float: left;
-        clear: both;
-        margin-bottom: 2px;
-    }}
-    
-    .user-timestamp {{
-        text-align: right;
-        font-size: 10px;
-        color: #666;
-        margin-left: 20%;
-        margin-bottom: 15px;
-        clear: both;
-    }}
-    
-    .assistant-timestamp {{
-        text-align: left;
-        font-size: 10px;
-        color: #666;
-        margin-right: 20%;
-        margin-bottom: 15px;
-        clear: both;
-    }}
-    
-    .message-container {{
-        display: block;
-        width: 100%;
-        margin-bottom: 10px;
-    }}
-    
-    .message-container::after {{
-        content: "";
-        display: table;
-        clear: both;
-    }}
-    
-    .scrollable-chat {{
-        height: 400px;
-        overflow-y: auto;
-        padding: 10px;
-        border: 1px solid #e0e0e0;
-        border-radius: 10px;
-        background-color: #fafafa;
-        font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, sans-serif;
-    }}
-    </style>
-    
-    <div class="scrollable-chat" id="scrollable-chat">
-        {chat_messages_html}
+# Chat message templates (filled with str.format, content is HTML-escaped first)
+USER_MESSAGE_HTML = """
+<div class="message-container">
+    <div class="user-message">
+        {content}
+    </div>
+    <div class="user-timestamp">
+        {timestamp}
+    </div>
+</div>
+"""
+
+ASSISTANT_MESSAGE_HTML = """
+<div class="message-container">
+    <div class="assistant-message">
+        {content}
+    </div>
+    <div class="assistant-timestamp">
+        {timestamp}{latency}
     </div>
+</div>
+"""
+
+# Message content only ever lands in element text, where & < > are the characters to escape
+HTML_TEXT_ESCAPES = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;'})
+
+def render_message_html(message: dict) -> str:
+    """Render a single chat message to HTML, memoized per session"""
+    cache = st.session_state.setdefault('_message_html_cache', {})
+    cache_key = (message["role"], message.get("timestamp"), message["content"], message.get("latency"))
+    if cache_key in cache:
+        return cache[cache_key]
+    
+    # Display time is precomputed on append; older messages fall back to formatting
+    timestamp_str = message.get("ts_display") or format_message_time(message.get("timestamp"))
+    content = message["content"].translate(HTML_TEXT_ESCAPES)
+    
+    if message["role"] == "user":
+        message_html = USER_MESSAGE_HTML.format(content=content, timestamp=timestamp_str)
+    else:
+        latency_text = ""
+        if "latency" in message and message["latency"] is not None:
+            latency_text = f" • {message['latency']}s"
+        
+        message_html = ASSISTANT_MESSAGE_HTML.format(content=content, timestamp=timestamp_str, latency=latency_text)
+    
+    # Messages without a timestamp show the current time, so don't cache them
+    if "timestamp" in message:
+        cache[cache_key] = message_html
+    return message_html
+
+# Number of most recent messages rendered; older ones are loaded on demand
+CHAT_WINDOW = 50
+
+def render_custom_chat(conversation, window: int = CHAT_WINDOW):
+    """Render chat with custom CSS (original look and feel)"""
+    messages = conversation.get("messages", [])
+    
+    # Messages are only ever appended, so count + last timestamp identify a revision
+    revision = (len(messages), messages[-1].get("timestamp") if messages else None, window)
+    html_cache = st.session_state.setdefault('_chat_html_cache', {})
+    cached = html_cache.get(conversation['id'])
+    if cached and cached[0] == revision:
+        chat_messages_html = cached[1]
+    else:
+        chat_messages_html = "".join(render_message_html(message) for message in messages[-window:])
+        html_cache[conversation['id']] = (revision, chat_messages_html)
     
-    <script>
-    // Auto-scroll to bottom
-    const container = document.getElementById('scrollable-chat');
-    if (container) {{
-        container.scrollTop = container.scrollHeight;
-    }}
-    </script>
-    """, height=450)
+    # Render inline (styled by static/chat.css) rather than in a per-rerun iframe
+    st.html('<div class="scrollable-chat"><div>' + chat_messages_html + '</div></div>')
 
 def render_mobile_chat():
     """Render mobile-friendly chat interface with original custom styling"""
@@ -1034,6 +1175,35 @@ def render_mobile_chat():
         st.error("Conversation not found")
         return
     
+    # A submitted message is handled before anything is drawn so this run already shows
+    # the new turn (the submitted text is in session state before the input is rendered)
+    waiting_for_reply = conv['id'] in st.session_state.get('_pending_replies', {})
+    if not waiting_for_reply and (prompt := st.session_state.get("chat_input")):
+        # Add user message with its display time precomputed
+        now = now_ts()
+        message = {
+            "role": "user",
+            "content": prompt,
+            "timestamp": now,
+            "ts_display": format_message_time(now),
+            "latency": None
+        }
+        conv["messages"].append(message)
+        append_message_to_storage(conv['id'], message)
+        
+        conv['user_message_count'] += 1
+        
+        # Update conversation title if this is the first user message
+        if conv['user_message_count'] == 1:
+            update_conversation_title(conv['id'], prompt)
+        
+        # Call API in the background; poll_pending_replies picks up the answer
+        start_reply_generation(conv, prompt)
+        waiting_for_reply = True
+    
+    # Chat input (mobile-optimized, pinned to the bottom of the page), disabled until the reply arrives
+    st.chat_input("Type your message here...", key="chat_input", disabled=waiting_for_reply)
+    
     # Chat header with "Generate Summary" button on the right
     col1, col2 = st.columns([4, 1])
     
@@ -1041,46 +1211,79 @@ def render_mobile_chat():
         st.markdown(f"### 💬 {conv.get('title', 'Untitled Conversation')}")
         st.caption(f"Session ID: `{conv['session_id']}`")
     with col2:
-        if st.button("📝 Generate Summary", key="generate_summary", use_container_width=True):
-            with st.spinner("Generating summary..."):
-                response = call_api("Generate summary for this conversation.", conv["session_id"], generate_summary=True)
-                if response:
-                    process_response(response, conv["id"], summary=True)
-                    st.success("✅ Summary generated!")
-                    st.rerun()
-                else:
-                    st.error("Failed to generate summary")
+        # Generated in the background (and not twice at once); poll_pending_summaries stores it
+        summary_pending = conv['id'] in st.session_state.get('_pending_summary_futures', {})
+        if st.button("📝 Generate Summary", key="generate_summary", use_container_width=True, disabled=summary_pending):
+            start_summary_generation(conv)
     st.markdown("---")
     
-    # Display chat messages using original custom interface
-    render_custom_chat(conv)
+    # Display chat messages using original custom interface, windowed to the latest ones
+    chat_windows = st.session_state.setdefault('_chat_windows', {})
+    window = chat_windows.get(conv['id'], CHAT_WINDOW)
+    hidden_count = len(conv['messages']) - window
+    if hidden_count > 0:
+        if st.button(f"⬆️ Load earlier messages ({hidden_count} hidden)", key="load_earlier", use_container_width=True):
+            chat_windows[conv['id']] = window + CHAT_WINDOW
+            st.rerun()
+    
+    render_custom_chat(conv, window)
     
     st.markdown("---")
+
+# Symptom sections of the assessment: (state key, heading, show details)
+ASSESSMENT_SECTIONS = (
+    ('present_symptoms', "Present Symptoms", True),
+    ('absent_symptoms', "Absent Symptoms", False),
+    ('risk_factors', "Risk Factors", True),
+)
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def build_assessment_markdown(state_json: bytes) -> str:
+    """Build the Live Assessment markdown for a serialized state ("" if there is no data yet)"""
+    state = orjson.loads(state_json)
     
-    # Chat input (mobile-optimized)
-    if prompt := st.chat_input("Type your message here...", key="chat_input"):
-        # Add user message with local timezone
-        conv["messages"].append({
-            "role": "user",
-            "content": prompt,
-            "timestamp": datetime.now(LOCAL_TZ),
-            "latency": None
-        })
-        
-        # Update conversation title if this is the first user message
-        if len([m for m in conv['messages'] if m['role'] == 'user']) == 1:
-            update_conversation_title(conv['id'], prompt)
-        
-        save_conversations_to_storage()
-        
-        # Call API
-        with st.spinner("Thinking..."):
-            response = call_api(prompt, conv["session_id"])
-            if response:
-                process_response(response, conv['id'])
-                st.rerun()
-            else:
-                st.error("Failed to get response from AI")
+    # Check if there's any meaningful data
+    has_meaningful_data = bool(state and isinstance(state, dict) and any(
+        v for k, v in state.items() 
+        if k not in ['timestamp', 'session_id', 'user_language'] and v
+    ))
+    if not has_meaningful_data:
+        return ""
+    
+    parts = []
+    
+    # Display result and reasoning
+    if 'result' in state and state['result']:
+        parts.append(f"**Result:** `{state['result'].upper()}`")
+    
+    # Display present symptoms, absent symptoms and risk factors
+    for key, heading, with_details in ASSESSMENT_SECTIONS:
+        if state.get(key):
+            parts.append(f"**{heading}:**\n\n" + symptom_list_markdown(state[key], with_details))
+    
+    return "\n\n".join(parts)
+
+def symptom_list_markdown(symptom_items: list, with_details: bool = False) -> str:
+    """Markdown bullet list of symptoms, with details as a nested list"""
+    lines = []
+    for symptom_item in symptom_items:
+        if isinstance(symptom_item, dict):
+            lines.append(f"- {symptom_item.get('symptom', 'Unknown').title()}")
+            if with_details:
+                lines.extend(f"    - {detail}" for detail in symptom_item.get('details') or ())
+    return "\n".join(lines)
+
+def set_assessment_markdown(conversation_id: str, state: dict):
+    """Render a conversation's assessment once, when its state is ingested"""
+    markdown_cache = st.session_state.setdefault('_assessment_markdown', {})
+    markdown_cache[conversation_id] = build_assessment_markdown(orjson.dumps(state, option=orjson.OPT_SORT_KEYS))
+
+def get_assessment_markdown(conversation_id: str, conversation: dict) -> str:
+    """Rendered assessment for a conversation (conversations loaded from disk render on first use)"""
+    markdown_cache = st.session_state.setdefault('_assessment_markdown', {})
+    if conversation_id not in markdown_cache:
+        set_assessment_markdown(conversation_id, get_assessment_state(conversation))
+    return markdown_cache[conversation_id]
 
 def render_sidebar_assessment():
     """Render assessment details in sidebar as expandable field"""
@@ -1092,59 +1295,13 @@ def render_sidebar_assessment():
     if not conv:
         return
     
-    # Get current assessment state (from custom_outputs)
-    state = conv.get('state', {})
-    
-    # Check if there's any meaningful data
-    has_meaningful_data = bool(state and isinstance(state, dict) and any(
-        v for k, v in state.items() 
-        if k not in ['timestamp', 'session_id', 'user_language'] and v
-    ))
+    # Assessment markdown was rendered when the state (custom_outputs) was ingested
+    assessment_markdown = get_assessment_markdown(st.session_state.current_conversation_id, conv)
     
     # Show expander with assessment details
     with st.expander("📋 Live Assessment", expanded=True):
-        if has_meaningful_data:
-            # Display result and reasoning
-            if 'result' in state and state['result']:
-                st.markdown(f"**Result:** `{state['result'].upper()}`")
-                st.markdown("")
-
-            # Display present symptoms
-            if 'present_symptoms' in state and state['present_symptoms']:
-                st.markdown("**Present Symptoms:**")
-                for symptom_item in state['present_symptoms']:
-                    if isinstance(symptom_item, dict):
-                        symptom_name = symptom_item.get('symptom', 'Unknown')
-                        st.markdown(f"- {symptom_name.title()}")
-                        
-                        details = symptom_item.get('details', [])
-                        if details:
-                            for detail in details:
-                                st.markdown(f"&nbsp;&nbsp;&nbsp;&nbsp;- {detail}")
-                st.markdown("")
-            
-            # Display absent symptoms
-            if 'absent_symptoms' in state and state['absent_symptoms']:
-                st.markdown("**Absent Symptoms:**")
-                for symptom_item in state['absent_symptoms']:
-                    if isinstance(symptom_item, dict):
-                        symptom_name = symptom_item.get('symptom', 'Unknown')
-                        st.markdown(f"- {symptom_name.title()}")
-                st.markdown("")
-            
-            # Display risk factors
-            if 'risk_factors' in state and state['risk_factors']:
-                st.markdown("**Risk Factors:**")
-                for symptom_item in state['risk_factors']:
-                    if isinstance(symptom_item, dict):
-                        symptom_name = symptom_item.get('symptom', 'Unknown')
-                        st.markdown(f"- {symptom_name.title()}")
-                        
-                        details = symptom_item.get('details', [])
-                        if details:
-                            for detail in details:
-                                st.markdown(f"&nbsp;&nbsp;&nbsp;&nbsp;- {detail}")
-                st.markdown("")
+        if assessment_markdown:
+            st.markdown(assessment_markdown)
         else:
             st.info("No assessment data yet")
     
@@ -1162,17 +1319,51 @@ def render_mobile_assessment():
 
 def main_app():
     """Main application interface"""
-    init_session_state()
+    init_conversations()
+    
+    # Pick up replies and summaries generated in the background
+    collect_pending_replies()
+    collect_pending_summaries()
+    
+    # Main content area first, so the sidebar below reflects this run's new messages
+    render_mobile_chat()
+    
+    # Keep polling while any conversation (not just the current one) awaits a reply
+    if st.session_state.get('_pending_replies'):
+        poll_pending_replies()
     
     # Render sidebar
     render_mobile_sidebar()
     
-    # Main content area
-    render_mobile_chat()
+    # Keep polling while summaries (possibly started by this run's turn) are in flight
+    if st.session_state.get('_pending_summary_futures'):
+        poll_pending_summaries()
     
     # Assessment section
     render_mobile_assessment()
 
+@st.fragment
+def render_user_sidebar():
+    """Render logged-in user info and logout button (as a fragment, it reruns on its own)"""
+    st.title("🏥 AI Triage")
+    st.markdown("---")
+    # Display logged in user email
+    user_email = st.session_state.get('user_email', 'Unknown')
+    st.markdown(f"**👤 Logged in as:**")
+    st.markdown(f"`{user_email}`")
+    st.markdown("")
+    if st.button("🚪 Logout", use_container_width=True):
+        # Write out any pending changes, then drop this user's conversations
+        flush_conversations(include_pending_turns=True)
+        st.session_state.pop('conversations', None)
+        st.session_state.pop('_assessment_markdown', None)
+        st.session_state.pop('_loaded_email', None)
+        st.session_state.authenticated = False
+        st.session_state.user_email = None
+        # Clear auth from storage
+        clear_auth_from_storage()
+        st.rerun()
+
 def login_page():
     """Login page with Google Sign-In"""
     st.title("🏥 AI Triage Demo")
@@ -1183,74 +1374,111 @@ def login_page():
     
     st.markdown("---")
     
-    # Fallback: Simple email login
+    # Fallback: email login, verified with a one-time code sent to the address
     st.markdown("### 📧 Sign in with email")
-    st.markdown("Enter your authorized email to access the system.")
     
-    email = st.text_input("Email Address", placeholder="your.email@example.com")
+    if not st.session_state.otp_sent:
+        st.markdown("Enter your authorized email to receive a sign-in code.")
+        
+        email = st.text_input("Email Address", placeholder="your.email@example.com")
+        
+        if st.button("Send Sign-in Code", use_container_width=True, type="primary"):
+            email = email.strip().lower()
+            if not email:
+                st.error("❌ Please enter an email address.")
+            elif not is_valid_email(email):
+                st.error("❌ Please enter a valid email address.")
+            else:
+                # Check if email is authorized
+                authorized_emails = st.secrets.get("AUTHORIZED_EMAILS", "")
+                if is_email_authorized(email, authorized_emails):
+                    otp = generate_otp()
+                    st.session_state.otp_code = otp
+                    st.session_state.otp_email = email
+                    st.session_state.otp_expires_at = now_ts() + OTP_TTL
+                    st.session_state.otp_attempts = 0
+                    st.session_state.otp_sent = True
+                    send_otp_email(email, otp)
+                    st.rerun()
+                else:
+                    st.error("❌ Unauthorized email address or domain.")
+        return
     
-    if st.button("Continue with Email", use_container_width=True, type="primary"):
-        if not email:
-            st.error("❌ Please enter an email address.")
-        elif not is_valid_email(email):
-            st.error("❌ Please enter a valid email address.")
-        else:
-            # Check if email is authorized
-            authorized_emails = st.secrets.get("AUTHORIZED_EMAILS", "").split(",")
-            if is_email_authorized(email, authorized_emails):
-                # Generate auth token
-                auth_token = generate_auth_token(email)
-                
-                # Save to storage
-                save_auth_to_storage(email, auth_token)
-                
-                # Set session state
-                st.session_state.authenticated = True
-                st.session_state.user_email = email
-                
-                st.success("✅ Login successful!")
-                st.rerun()
+    st.markdown(f"Enter the 6-digit code sent to `{st.session_state.otp_email}`.")
+    code = st.text_input("Sign-in Code", max_chars=6)
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        verify_clicked = st.button("Verify", use_container_width=True, type="primary")
+    with col2:
+        if st.button("Use a different email", use_container_width=True):
+            reset_otp()
+            st.rerun()
+    
+    if verify_clicked:
+        if now_ts() > st.session_state.otp_expires_at:
+            reset_otp()
+            st.error("❌ The code has expired. Please request a new one.")
+        elif not hmac.compare_digest(code.strip().encode(), st.session_state.otp_code.encode()):
+            st.session_state.otp_attempts += 1
+            if st.session_state.otp_attempts >= OTP_MAX_ATTEMPTS:
+                reset_otp()
+                st.error("❌ Too many incorrect codes. Please request a new one.")
             else:
-                st.error("❌ Unauthorized email address or domain.")
+                st.error("❌ Incorrect code.")
+        else:
+            email = st.session_state.otp_email
+            reset_otp()
+            
+            # Save a signed auth token to storage
+            save_auth_to_storage(email)
+            
+            # Set session state
+            st.session_state.authenticated = True
+            st.session_state.user_email = email
+
+def restore_auth_from_storage():
+    """Log the user back in from the auth stored in the URL, if any"""
+    auth_data = load_auth_from_storage()
+    if auth_data and isinstance(auth_data, dict):
+        email = auth_data.get('email')
+        if not isinstance(email, str) or not is_valid_email(email) or 'token' not in auth_data:
+            return
+        
+        # Token must be signed by us for this email, and the email must still be allowed
+        # (you can add expiration logic here if needed)
+        authorized_emails = st.secrets.get("AUTHORIZED_EMAILS", "")
+        if is_auth_token_valid(auth_data) and is_email_authorized(email, authorized_emails):
+            st.session_state.authenticated = True
+            st.session_state.user_email = email
 
 def main():
     """Main application entry point"""
     init_session_state()
     
-    # Check if authenticated via storage
-    if "authenticated" not in st.session_state:
-        st.session_state.authenticated = False
+    # Once authenticated, reruns skip reading auth from the URL entirely
+    if not st.session_state.authenticated:
+        restore_auth_from_storage()
     
     if not st.session_state.authenticated:
-        # Try to load auth from storage
-        auth_data = load_auth_from_storage()
-        if auth_data and isinstance(auth_data, dict):
-            if 'email' in auth_data and 'token' in auth_data:
-                # Validate token is still valid (you can add expiration logic here if needed)
-                st.session_state.authenticated = True
-                st.session_state.user_email = auth_data['email']
+        # Drawn in a placeholder so a successful login can clear it and
+        # carry on into the app in the same run instead of rerunning
+        login_placeholder = st.empty()
+        with login_placeholder.container():
+            login_page()
+        if st.session_state.authenticated:
+            login_placeholder.empty()
     
-    # Show appropriate page
     if st.session_state.authenticated:
         # Add user info and logout button in sidebar
         with st.sidebar:
-            st.title("🏥 AI Triage")
-            st.markdown("---")
-            # Display logged in user email
-            user_email = st.session_state.get('user_email', 'Unknown')
-            st.markdown(f"**👤 Logged in as:**")
-            st.markdown(f"`{user_email}`")
-            st.markdown("")
-            if st.button("🚪 Logout", use_container_width=True):
-                st.session_state.authenticated = False
-                st.session_state.user_email = None
-                # Clear auth from storage
-                clear_auth_from_storage()
-                st.rerun()
+            render_user_sidebar()
         
         main_app()
-    else:
-        login_page()
+    
+    # Persist any conversation changes made during this run in one write
+    flush_conversations()
+    flush_query_params()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file